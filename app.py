@@ -1,10 +1,22 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from typing import Dict, List, Generator
+from typing import Dict, FrozenSet, List, Generator
 import re
+import io
 import time
 
+# orjson이 있으면 더 빠른 JSON 파서 사용
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    _json_loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
+
 # 페이지 설정
 st.set_page_config(
     page_title="DeepSeek-R1 Chatbot",
@@ -16,28 +28,121 @@ st.set_page_config(
 OLLAMA_BASE_URL = "http://localhost:11434"
 DEEPSEEK_MODEL = "deepseek-r1:8b"
 
+# 스트리밍 중 화면 갱신 최소 간격 (초)
+STREAM_FLUSH_INTERVAL = 0.05
+
+# 한 번에 화면에 표시할 최근 메시지 수
+HISTORY_PAGE_SIZE = 50
+
+# 질문 템플릿
+TEMPLATE_OPTIONS = {
+    "일반 대화": "",
+    "수학 문제": "다음 수학 문제를 단계별로 풀어주세요:\n",
+    "코딩 문제": "다음 프로그래밍 문제를 해결해주세요:\n",
+    "논리적 추론": "다음 문제를 논리적으로 분석해주세요:\n",
+    "창의적 글쓰기": "다음 주제로 창의적인 글을 써주세요:\n"
+}
+
+# 샘플 질문
+SAMPLE_QUESTIONS = (
+    "25 × 37을 단계별로 계산해주세요",
+    "Python으로 피보나치 수열을 구현하는 방법",
+    "왜 하늘은 파란색일까요?",
+    "창의적인 단편소설 아이디어를 제안해주세요",
+    "기후변화의 주요 원인 3가지는?",
+    "간단한 암호화 알고리즘을 설명해주세요",
+)
+
+# <think> 태그 패턴 (모듈 로드 시 한 번만 컴파일)
+_THINK_RE = re.compile(r'<think>(.*?)</think>', re.DOTALL)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_models(base_url: str, _session: requests.Session) -> FrozenSet[str]:
+    """모델 목록 조회 (60초 캐시, 실패 시 예외를 던져 캐시하지 않음)"""
+    response = _session.get(f"{base_url}/api/tags", timeout=10)
+    response.raise_for_status()
+    models = response.json().get("models", [])
+    return frozenset(model["name"] for model in models)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _check_connection(base_url: str, _session: requests.Session) -> bool:
+    """서버 연결 확인 (5초 캐시, 실패 시 예외를 던져 캐시하지 않음)"""
+    response = _session.get(f"{base_url}/api/tags", timeout=5)
+    response.raise_for_status()
+    return True
+
+class _NDJSONBuffer:
+    """바이트 청크를 NDJSON 줄로 분리 (디코딩은 JSON 파서에 맡김)"""
+
+    def __init__(self):
+        self._pending = b""  # 아직 줄바꿈이 오지 않은 마지막 조각
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        lines = (self._pending + chunk).split(b"\n")
+        self._pending = lines.pop()
+        return lines
+
+    def flush(self) -> List[bytes]:
+        pending, self._pending = self._pending, b""
+        return [pending] if pending else []
+
+def _parse_chat_line(line: bytes) -> tuple[str, bool]:
+    """/api/chat 스트림 한 줄에서 (응답 조각, 완료 여부) 추출"""
+    if not line:
+        return "", False
+    try:
+        data = _json_loads(line)
+    except _JSONDecodeError:
+        return "", False
+    return data.get('message', {}).get('content', ""), data.get('done', False)
+
 class OllamaClient:
     def __init__(self, base_url: str = OLLAMA_BASE_URL):
         self.base_url = base_url
+        # 연결 재사용 (HTTP keep-alive) + 일시적 오류 재시도
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=10,
+            max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("http://", adapter)
 
     def check_connection(self) -> bool:
         """Ollama 서버 연결 확인"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
-            return response.status_code == 200
+            return _check_connection(self.base_url, self.session)
         except requests.exceptions.RequestException:
+            # 연결이 끊겼으면 캐시된 모델 목록도 무효화
+            _fetch_models.clear()
             return False
 
-    def get_models(self) -> List[str]:
+    def get_models(self) -> FrozenSet[str]:
         """사용 가능한 모델 목록 가져오기"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
-            if response.status_code == 200:
-                models = response.json().get("models", [])
-                return [model["name"] for model in models]
-            return []
+            return _fetch_models(self.base_url, self.session)
         except requests.exceptions.RequestException:
-            return []
+            return frozenset()
+
+    @staticmethod
+    def _iter_ndjson_lines(response: requests.Response) -> Generator[bytes, None, None]:
+        """NDJSON 스트림을 줄 단위(bytes)로 분리"""
+        raw = response.raw
+        if raw.chunked:
+            # chunked 전송은 큰 chunk_size여도 도착한 HTTP 청크 단위로 바로 반환됨
+            chunks = response.iter_content(chunk_size=65536)
+        elif hasattr(raw, "read1"):
+            # Content-Length 응답(버퍼링 프록시 등)은 64KiB가 찰 때까지 막히므로
+            # 이미 도착한 만큼만 읽음
+            chunks = iter(lambda: raw.read1(65536, decode_content=True), b"")
+        else:
+            yield from response.iter_lines()
+            return
+
+        buffer = _NDJSONBuffer()
+        for chunk in chunks:
+            yield from buffer.feed(chunk)
+        yield from buffer.flush()
 
     def chat_stream(self, model: str, messages: List[Dict], **kwargs) -> Generator[str, None, None]:
         """스트리밍 채팅 응답"""
@@ -49,57 +154,153 @@ class OllamaClient:
         }
 
         try:
-            response = requests.post(
+            with self.session.post(
                 f"{self.base_url}/api/chat",
                 json=payload,
                 stream=True,
                 timeout=120  # DeepSeek-R1은 추론 시간이 길 수 있음
-            )
-
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line.decode('utf-8'))
-                            if 'message' in data and 'content' in data['message']:
-                                yield data['message']['content']
-                            if data.get('done', False):
-                                break
-                        except json.JSONDecodeError:
+            ) as response:
+                if response.status_code == 200:
+                    done = False
+                    for line in self._iter_ndjson_lines(response):
+                        # done 이후에도 끝까지 읽어야 연결이 풀로 반환됨 (keep-alive)
+                        if done:
                             continue
-            else:
-                yield f"오류 발생: HTTP {response.status_code}"
+                        content, done = _parse_chat_line(line)
+                        if content:
+                            yield content
+                else:
+                    response.content  # 본문을 읽어 연결을 풀로 반환
+                    yield f"오류 발생: HTTP {response.status_code}"
 
         except requests.exceptions.RequestException as e:
             yield f"연결 오류: {str(e)}"
 
 def parse_deepseek_response(response: str) -> tuple[str, str]:
     """DeepSeek-R1 응답에서 추론 과정과 최종 답변 분리"""
+    # <think> 태그가 없으면 정규식 없이 바로 반환
+    if '<think>' not in response:
+        return "", response.strip()
+
     # <think> 태그로 감싸진 추론 과정 추출
-    thinking_pattern = r'<think>(.*?)</think>'
-    thinking_match = re.search(thinking_pattern, response, re.DOTALL)
+    thinking_match = _THINK_RE.search(response)
 
     if thinking_match:
         thinking = thinking_match.group(1).strip()
-        # <think> 태그 제거한 나머지가 최종 답변
-        final_answer = re.sub(thinking_pattern, '', response, flags=re.DOTALL).strip()
+        # <think> 블록을 모두 제거한 나머지가 최종 답변 (블록이 하나면 슬라이싱으로 충분)
+        if _THINK_RE.search(response, thinking_match.end()):
+            final_answer = _THINK_RE.sub('', response).strip()
+        else:
+            final_answer = (response[:thinking_match.start()] + response[thinking_match.end():]).strip()
     else:
-        # <think> 태그가 없는 경우 전체를 최종 답변으로 처리
-        thinking = ""
-        final_answer = response.strip()
+        # <think> 태그가 닫히지 않은 경우 (생성 중단) 태그 이후는 추론 과정으로 처리
+        think_start = response.find('<think>')
+        thinking = response[think_start + len('<think>'):].strip()
+        final_answer = response[:think_start].strip()
 
     return thinking, final_answer
 
+class StreamSplitter:
+    """스트리밍 청크를 추론 과정과 최종 답변으로 점진적으로 분리"""
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""  # 청크 경계에 걸친 태그 조각
+        self.thinking_buf = io.StringIO()
+        self.answer_buf = io.StringIO()
+
+    @staticmethod
+    def _partial_tag_len(text: str, tag: str) -> int:
+        """text 끝부분이 tag의 앞부분과 겹치는 길이"""
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> tuple[str, str]:
+        """새 청크를 처리하고 (새 추론 조각, 새 답변 조각) 반환"""
+        text = self._pending + chunk
+        self._pending = ""
+        thinking_parts: List[str] = []
+        answer_parts: List[str] = []
+
+        while text:
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            parts = thinking_parts if self.in_think else answer_parts
+            idx = text.find(tag)
+            if idx == -1:
+                # 태그가 잘려서 들어온 경우 다음 청크까지 보류
+                keep = self._partial_tag_len(text, tag)
+                if keep:
+                    self._pending = text[-keep:]
+                    text = text[:-keep]
+                parts.append(text)
+                break
+            parts.append(text[:idx])
+            text = text[idx + len(tag):]
+            self.in_think = not self.in_think
+
+        new_thinking = "".join(thinking_parts)
+        new_answer = "".join(answer_parts)
+        self.thinking_buf.write(new_thinking)
+        self.answer_buf.write(new_answer)
+        return new_thinking, new_answer
+
+    def flush(self) -> tuple[str, str]:
+        """스트림 종료 시 보류 중인 조각을 현재 버퍼로 내보내고 (새 추론 조각, 새 답변 조각) 반환"""
+        pending, self._pending = self._pending, ""
+        if self.in_think:
+            self.thinking_buf.write(pending)
+            return pending, ""
+        self.answer_buf.write(pending)
+        return "", pending
+
+    @property
+    def thinking(self) -> str:
+        return self.thinking_buf.getvalue().strip()
+
+    @property
+    def answer(self) -> str:
+        return self.answer_buf.getvalue().strip()
+
+def build_api_messages(messages: List[Dict]) -> List[Dict]:
+    """Ollama로 보낼 대화 기록 생성
+
+    "thinking"은 화면 표시 전용이므로 보내지 않고, assistant 내용에 <think> 블록이
+    남아 있으면 (닫히지 않은 경우 포함) 제거해 다음 턴의 프롬프트 처리량을 줄입니다.
+    """
+    api_messages = []
+    for m in messages:
+        content = m["content"]
+        if m["role"] == "assistant":
+            _, content = parse_deepseek_response(content)
+        api_messages.append({"role": m["role"], "content": content})
+    return api_messages
+
 # 세션 상태 초기화
+# messages 항목: {"role", "content"} (+ assistant는 화면 표시 전용 "thinking")
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# 메시지 수 카운터 (통계 표시 시 매번 목록을 훑지 않도록)
+if "user_count" not in st.session_state:
+    st.session_state.user_count = 0
+
+if "assistant_count" not in st.session_state:
+    st.session_state.assistant_count = 0
+
 if "ollama_client" not in st.session_state:
     st.session_state.ollama_client = OllamaClient()
 
 if "show_thinking" not in st.session_state:
     st.session_state.show_thinking = True
 
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+
 def main():
     st.title("🧠 DeepSeek-R1 Chatbot")
     st.markdown("**추론 과정을 보여주는 AI 모델과 채팅하기**")
@@ -146,37 +347,36 @@ def main():
 
         # 프롬프트 템플릿
         st.subheader("📝 질문 템플릿")
-        template_options = {
-            "일반 대화": "",
-            "수학 문제": "다음 수학 문제를 단계별로 풀어주세요:\n",
-            "코딩 문제": "다음 프로그래밍 문제를 해결해주세요:\n",
-            "논리적 추론": "다음 문제를 논리적으로 분석해주세요:\n",
-            "창의적 글쓰기": "다음 주제로 창의적인 글을 써주세요:\n"
-        }
-
-        selected_template = st.selectbox("질문 유형 선택:", list(template_options.keys()))
+        selected_template = st.selectbox("질문 유형 선택:", list(TEMPLATE_OPTIONS))
 
         st.divider()
 
         # 대화 기록 관리
         if st.button("🗑️ 대화 기록 삭제"):
             st.session_state.messages = []
+            st.session_state.user_count = 0
+            st.session_state.assistant_count = 0
+            st.session_state.history_limit = HISTORY_PAGE_SIZE
             st.rerun()
 
         # 대화 통계
         if st.session_state.messages:
             st.subheader("📊 대화 통계")
-            user_msgs = len([m for m in st.session_state.messages if m["role"] == "user"])
-            assistant_msgs = len([m for m in st.session_state.messages if m["role"] == "assistant"])
-            st.metric("사용자 메시지", user_msgs)
-            st.metric("AI 응답", assistant_msgs)
+            st.metric("사용자 메시지", st.session_state.user_count)
+            st.metric("AI 응답", st.session_state.assistant_count)
 
     # 메인 채팅 영역
     chat_container = st.container()
 
     with chat_container:
-        # 대화 기록 표시
-        for message in st.session_state.messages:
+        # 대화 기록 표시 (최근 메시지만 렌더링, API에는 전체 기록 전달)
+        hidden_count = len(st.session_state.messages) - st.session_state.history_limit
+        if hidden_count > 0:
+            if st.button(f"⬆️ 이전 메시지 더 보기 ({hidden_count}개)"):
+                st.session_state.history_limit += HISTORY_PAGE_SIZE
+                st.rerun()
+
+        for message in st.session_state.messages[-st.session_state.history_limit:]:
             with st.chat_message(message["role"]):
                 if message["role"] == "assistant" and "thinking" in message:
                     # 추론 과정이 있는 경우
@@ -192,11 +392,12 @@ def main():
 
         if prompt_input:
             # 템플릿 적용
-            template_prefix = template_options[selected_template]
+            template_prefix = TEMPLATE_OPTIONS[selected_template]
             full_prompt = template_prefix + prompt_input if template_prefix else prompt_input
 
             # 사용자 메시지 추가
             st.session_state.messages.append({"role": "user", "content": full_prompt})
+            st.session_state.user_count += 1
 
             # 사용자 메시지 표시
             with st.chat_message("user"):
@@ -210,14 +411,13 @@ def main():
 
                 message_placeholder = st.empty()
                 thinking_placeholder = st.empty()
-                full_response = ""
 
                 # 스트리밍 응답
                 try:
                     start_time = time.time()
                     response_stream = st.session_state.ollama_client.chat_stream(
                         model=DEEPSEEK_MODEL,
-                        messages=st.session_state.messages,
+                        messages=build_api_messages(st.session_state.messages),
                         options={
                             "temperature": temperature,
                             "num_predict": max_tokens,
@@ -226,33 +426,52 @@ def main():
                     )
 
                     first_chunk_received = False
+                    splitter = StreamSplitter()
+                    thinking_dirty = answer_dirty = False
+                    last_flush = time.monotonic()
                     for chunk in response_stream:
                         if not first_chunk_received:
                             progress_placeholder.empty()  # 진행 상황 메시지 제거
                             first_chunk_received = True
 
-                        full_response += chunk
+                        # 실시간으로 추론 과정과 최종 답변 분리 (새 청크만 처리)
+                        new_thinking, new_answer = splitter.feed(chunk)
+                        thinking_dirty = thinking_dirty or bool(new_thinking)
+                        answer_dirty = answer_dirty or bool(new_answer)
 
-                        # 실시간으로 추론 과정과 최종 답변 분리
-                        thinking, final_answer = parse_deepseek_response(full_response)
+                        # 화면 갱신은 일정 간격으로 모아서 처리
+                        now = time.monotonic()
+                        if now - last_flush < STREAM_FLUSH_INTERVAL:
+                            continue
+                        last_flush = now
 
                         # 추론 과정 표시 (옵션에 따라)
-                        if st.session_state.show_thinking and thinking:
-                            with thinking_placeholder.expander("🤔 추론 과정", expanded=True):
-                                st.markdown(f"```\n{thinking}\n```")
+                        if st.session_state.show_thinking and thinking_dirty:
+                            thinking = splitter.thinking
+                            if thinking:
+                                with thinking_placeholder.expander("🤔 추론 과정", expanded=True):
+                                    st.markdown(f"```\n{thinking}\n```")
+                        thinking_dirty = False
 
                         # 최종 답변 표시
-                        if final_answer:
-                            message_placeholder.markdown(final_answer + "▌")
+                        if answer_dirty:
+                            final_answer = splitter.answer
+                            if final_answer:
+                                message_placeholder.markdown(final_answer + "▌")
+                        answer_dirty = False
 
-                    # 최종 정리
-                    thinking, final_answer = parse_deepseek_response(full_response)
+                    # 최종 정리 (마지막 화면 갱신, 분리 결과는 splitter에서 가져옴)
+                    splitter.flush()
+                    thinking, final_answer = splitter.thinking, splitter.answer
 
                     if st.session_state.show_thinking and thinking:
                         with thinking_placeholder.expander("🤔 추론 과정", expanded=False):
                             st.markdown(f"```\n{thinking}\n```")
 
-                    message_placeholder.markdown(final_answer if final_answer else full_response)
+                    if final_answer:
+                        message_placeholder.markdown(final_answer)
+                    else:
+                        message_placeholder.warning("⚠️ 최종 답변 없이 응답이 끝났습니다. Max Tokens를 늘려보세요.")
 
                     # 응답 시간 표시
                     end_time = time.time()
@@ -263,40 +482,30 @@ def main():
                     progress_placeholder.empty()
                     error_msg = f"오류가 발생했습니다: {str(e)}"
                     message_placeholder.error(error_msg)
-                    full_response = error_msg
                     thinking = ""
                     final_answer = error_msg
 
-            # 응답을 대화 기록에 추가 (추론 과정 포함)
-            thinking, final_answer = parse_deepseek_response(full_response) if not full_response.startswith("오류") else ("", full_response)
+            # 응답을 대화 기록에 추가 (추론 과정 포함, 위에서 분리한 결과 재사용)
             st.session_state.messages.append({
                 "role": "assistant",
-                "content": final_answer if final_answer else full_response,
+                "content": final_answer,
                 "thinking": thinking
             })
+            st.session_state.assistant_count += 1
 
     # 샘플 질문 제안
     st.subheader("💡 샘플 질문")
-    col1, col2, col3 = st.columns(3)
-
-    sample_questions = [
-        "25 × 37을 단계별로 계산해주세요",
-        "Python으로 피보나치 수열을 구현하는 방법",
-        "왜 하늘은 파란색일까요?",
-        "창의적인 단편소설 아이디어를 제안해주세요",
-        "기후변화의 주요 원인 3가지는?",
-        "간단한 암호화 알고리즘을 설명해주세요"
-    ]
-
-    for i, question in enumerate(sample_questions):
-        col = [col1, col2, col3][i % 3]
-        if col.button(f"❓ {question[:20]}...", key=f"sample_{i}"):
+    cols = st.columns(3)
+
+    for i, question in enumerate(SAMPLE_QUESTIONS):
+        if cols[i % 3].button(f"❓ {question[:20]}...", key=f"sample_{i}"):
             st.session_state.sample_question = question
             st.rerun()
 
     # 샘플 질문 자동 입력
     if hasattr(st.session_state, 'sample_question'):
         st.session_state.messages.append({"role": "user", "content": st.session_state.sample_question})
+        st.session_state.user_count += 1
         del st.session_state.sample_question
         st.rerun()
 